@@ -11,11 +11,36 @@ OUTPUT: Selected image paths from the gallery view
 """
 
 import os
+import re
+import sys
 import json
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from .base_parser import BaseParser
+from .png_chunks import read_text_chunks
+
+try:
+    import orjson
+    
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    
+    _json_loads = orjson.loads  # Raises orjson.JSONDecodeError, a json.JSONDecodeError subclass
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# _pil_to_tensor wraps immutable PIL bytes with torch.frombuffer and only reads
+# them; silence the resulting warning for this module, once, at import time
+warnings.filterwarnings(
+    "ignore",
+    message="The given buffer is not writable",
+    category=UserWarning,
+    module=re.escape(__name__),
+)
 
 
 class ImageSearchParser(BaseParser):
@@ -30,6 +55,21 @@ class ImageSearchParser(BaseParser):
     # Session cache for storing options by session_id
     _session_cache = {}
     
+    # Query embeddings by (model_id, file digest), so re-running a search with
+    # tweaked options does not re-embed the same query images
+    _query_emb_cache = OrderedDict()
+    _query_emb_cache_bytes = 0
+    QUERY_EMB_CACHE_MAX_ENTRIES = 512
+    QUERY_EMB_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    
+    _pillow_simd_hint_logged = False
+    
+    # Below this many results, forking the ComfyUI process costs more than
+    # draft-mode metric decoding saves; each worker takes chunks of 8 results
+    METRICS_PROCESS_MIN_RESULTS = 256
+    METRICS_PROCESS_MAX_WORKERS = 8
+    METRICS_PROCESS_CHUNKSIZE = 8
+    
     @classmethod
     def _store_session_options(cls, session_id: str, options: dict):
         """Store options for a session."""
@@ -45,6 +85,32 @@ class ImageSearchParser(BaseParser):
         """Retrieve stored options for a session."""
         return cls._session_cache.get(session_id, {})
     
+    @classmethod
+    def _get_query_embedding(cls, key: tuple):
+        """Return a cached query embedding (or None) and mark it most recently used."""
+        vec = cls._query_emb_cache.get(key)
+        if vec is not None:
+            cls._query_emb_cache.move_to_end(key)
+        return vec
+    
+    @classmethod
+    def _store_query_embedding(cls, key: tuple, vec):
+        """Cache a query embedding as fp16, evicting least recently used entries."""
+        import numpy as np
+        
+        if key in cls._query_emb_cache:
+            cls._query_emb_cache_bytes -= cls._query_emb_cache.pop(key).nbytes
+        vec = np.asarray(vec, dtype=np.float16)
+        cls._query_emb_cache[key] = vec
+        cls._query_emb_cache_bytes += vec.nbytes
+        # Keep the cache bounded by entry count and total size
+        while cls._query_emb_cache and (
+            len(cls._query_emb_cache) > cls.QUERY_EMB_CACHE_MAX_ENTRIES
+            or cls._query_emb_cache_bytes > cls.QUERY_EMB_CACHE_MAX_BYTES
+        ):
+            _, evicted = cls._query_emb_cache.popitem(last=False)
+            cls._query_emb_cache_bytes -= evicted.nbytes
+    
     @classmethod
     def detect_input(cls, content) -> bool:
         """Check if content is image search options JSON."""
@@ -77,7 +143,7 @@ class ImageSearchParser(BaseParser):
             return None
         
         try:
-            options = json.loads(search_content[len(cls.IMAGE_SEARCH_MARKER):])
+            options = _json_loads(search_content[len(cls.IMAGE_SEARCH_MARKER):])
         except json.JSONDecodeError as e:
             if logger:
                 logger.error(f"[Image Search Parser] Invalid JSON: {e}")
@@ -100,7 +166,7 @@ class ImageSearchParser(BaseParser):
                 "options": options,
             }
         
-        display_content = cls.IMAGE_SEARCH_MARKER + json.dumps(gallery_data)
+        display_content = cls.IMAGE_SEARCH_MARKER + _json_dumps(gallery_data)
         content_hash = f"image_search_{gallery_data.get('session_id', '')}_{len(gallery_data.get('results', []))}"
         
         if logger:
@@ -132,7 +198,7 @@ class ImageSearchParser(BaseParser):
             from PIL import Image
             import folder_paths
             
-            data = json.loads(content[len(cls.OUTPUT_MARKER):])
+            data = _json_loads(content[len(cls.OUTPUT_MARKER):])
             
             # Get selected images metadata: [{type, subfolder, filename}, ...]
             selected_items = data.get("selected", [])
@@ -203,48 +269,38 @@ class ImageSearchParser(BaseParser):
             }
             resample = resample_map.get(resample_str, Image.LANCZOS)
             
-            if resolution_mode == "largest_image_resolution":
+            if resolution_mode in ("largest_image_resolution", "smallest_image_resolution"):
                 dims = []
                 for path in selected_paths:
                     try:
-                        with Image.open(path) as img:
-                            dims.append((img.width, img.height))
+                        dims.append(_read_image_size(path))
                     except Exception:
                         continue
                 if dims:
-                    resize_width, resize_height = max(dims, key=lambda x: x[0] * x[1])
-            elif resolution_mode == "smallest_image_resolution":
-                dims = []
-                for path in selected_paths:
-                    try:
-                        with Image.open(path) as img:
-                            dims.append((img.width, img.height))
-                    except Exception:
-                        continue
-                if dims:
-                    resize_width, resize_height = min(dims, key=lambda x: x[0] * x[1])
+                    pick = max if resolution_mode == "largest_image_resolution" else min
+                    resize_width, resize_height = pick(dims, key=lambda x: x[0] * x[1])
             
+            cls._log_pillow_simd_hint(logger)
             want_alpha = (resize_mode == "pad_transparent")
-            dark, light, all_imgs = [], [], []
+            # Padding would skew a mean over the output frame and cropping drops
+            # part of the image, so those modes measure brightness on the whole
+            # source, matching the gallery's is_dark; stretch/fit keep all content
+            measure_source = resize_mode.startswith(("pad_", "crop_"))
+            all_imgs, source_brightness = [], []
             
             for path in selected_paths:
                 try:
-                    pil = Image.open(path).convert("RGB")
+                    pil = cls._open_rgb(path, (resize_width, resize_height))
                 except Exception as e:
                     if logger:
                         logger.warning(f"[Image Search Parser] Failed to load {path}: {e}")
                     continue
                 
-                arr_gray = np.array(pil.convert("L"))
-                brightness = float(arr_gray.mean() / 255.0)
+                if measure_source:
+                    arr_gray = np.array(pil.convert("L"))
+                    source_brightness.append(float(arr_gray.mean() / 255.0))
                 pil_out = cls._resize_pil(pil, resize_width, resize_height, resize_mode, resample)
-                t = cls._pil_to_tensor(pil_out, want_alpha=want_alpha)
-                all_imgs.append(t)
-                
-                if brightness < brightness_split:
-                    dark.append(t)
-                else:
-                    light.append(t)
+                all_imgs.append(cls._pil_to_tensor(pil_out, want_alpha=want_alpha))
             
             if not all_imgs:
                 return {
@@ -253,9 +309,17 @@ class ImageSearchParser(BaseParser):
                     "content_hash": "image_search_output_error",
                 }
             
-            out_all = torch.stack(all_imgs, dim=0)
-            out_dark = torch.stack(dark, dim=0) if dark else out_all
-            out_light = torch.stack(light, dim=0) if light else out_all
+            stacked = torch.stack(all_imgs, dim=0)
+            if measure_source:
+                is_dark = np.array(source_brightness) < brightness_split
+            else:
+                is_dark = _dark_mask(stacked.numpy(), brightness_split)
+            
+            out_all = cls._normalize_images(stacked)
+            dark = torch.from_numpy(np.flatnonzero(is_dark))
+            light = torch.from_numpy(np.flatnonzero(~is_dark))
+            out_dark = out_all[dark] if len(dark) else out_all
+            out_light = out_all[light] if len(light) else out_all
             
             return {
                 "output_values": [out_all],
@@ -264,7 +328,7 @@ class ImageSearchParser(BaseParser):
                 "extra_outputs": {
                     "dark_images": out_dark,
                     "light_images": out_light,
-                    "image_paths": json.dumps(selected_paths),
+                    "image_paths": _json_dumps(selected_paths),
                 },
             }
         except json.JSONDecodeError as e:
@@ -301,11 +365,12 @@ class ImageSearchParser(BaseParser):
             if options.get("rebuild_index", False):
                 searcher.clear_cache()
             
-            files = cls._gather_files(
+            entries = cls._gather_files(
                 options.get("search_input_dir", True),
                 options.get("search_output_dir", True),
                 options.get("search_temp_dir", False),
             )
+            files = [path for path, _ in entries]
             
             if not files:
                 if logger:
@@ -314,8 +379,10 @@ class ImageSearchParser(BaseParser):
             
             index, index_vecs, meta = searcher.update_index(
                 files=files,
+                mtimes=[mtime for _, mtime in entries],
                 index_threads=int(options.get("index_threads", 8)),
                 embed_batch_size=int(options.get("embed_batch_size", 64)),
+                index_dtype=options.get("index_dtype", "fp16"),
             )
             
             query_paths = options.get("query_images", [])
@@ -324,44 +391,70 @@ class ImageSearchParser(BaseParser):
                     logger.warning("[Image Search Parser] No query images")
                 return None
             
-            query_pils = []
-            for qp in query_paths:
+            def load_query(qp):
                 try:
-                    pil = Image.open(qp).convert("RGB")
-                    query_pils.append(pil)
+                    key = (model_id, _file_digest(qp))
+                    # Take hits now; storing this batch's misses may evict them later
+                    vec = cls._get_query_embedding(key)
+                    if vec is not None:
+                        return (key, vec, None)
+                    return (key, None, Image.open(qp).convert("RGB"))
                 except Exception as e:
                     if logger:
                         logger.warning(f"[Image Search Parser] Failed to load query image {qp}: {e}")
+                    return None
             
-            if not query_pils:
+            # Hash and decode query images in parallel; already embedded images skip decoding
+            index_threads = max(1, int(options.get("index_threads", 8)))
+            with ThreadPoolExecutor(max_workers=min(index_threads, len(query_paths))) as executor:
+                loaded = [r for r in executor.map(load_query, query_paths) if r is not None]
+            
+            if not loaded:
                 return None
             
-            q_vecs = searcher.embed_pils(query_pils, batch_size=int(options.get("embed_batch_size", 64)))
+            miss_pils = [pil for _, _, pil in loaded if pil is not None]
+            if miss_pils:
+                miss_vecs = iter(searcher.embed_pils(miss_pils, batch_size=int(options.get("embed_batch_size", 64))))
+            
+            q_rows = []
+            for key, vec, pil in loaded:
+                if pil is None:
+                    q_rows.append(vec)
+                else:
+                    vec = next(miss_vecs)
+                    cls._store_query_embedding(key, vec)
+                    q_rows.append(vec)
+            q_vecs = np.stack(q_rows).astype(np.float32)
             
             similarity_threshold = float(options.get("similarity_threshold", 0.85))
             max_results = int(options.get("max_results", 64))
-            pool_k = max(max_results * 4, max_results, 16)
+            # Never ask for more candidates than the index holds
+            pool_k = min(max(max_results * 4, 16), max(len(meta["paths"]), 1))
             
             scores, ids = searcher.search(q_vecs, index, index_vecs, top_k=pool_k)
             
-            collected = {}
-            q_count = scores.shape[0]
-            for qi in range(q_count):
-                row_s = scores[qi]
-                row_i = ids[qi]
-                for s, i in zip(row_s, row_i):
-                    s = float(s)
-                    if s < similarity_threshold:
-                        continue
-                    m = meta[int(i)]
-                    p = m["path"]
-                    prev = collected.get(p, None)
-                    if prev is None or prev["score"] < s:
-                        collected[p] = {"score": s, "meta": m}
+            # Flatten all query rows, keep hits above threshold and take the best
+            # score per file (first occurrence after a descending sort)
+            flat_s = scores.ravel()
+            flat_i = ids.ravel()
+            meta_paths = meta["paths"]
+            mask = (flat_s >= similarity_threshold) & (flat_i >= 0) & (flat_i < len(meta_paths))
+            flat_s = flat_s[mask]
+            flat_i = flat_i[mask]
+            order = np.argsort(-flat_s, kind="stable")
+            flat_s = flat_s[order]
+            flat_i = flat_i[order]
+            # Dedupe on path so re-indexed files only appear once
+            _, first = np.unique(meta_paths[flat_i], return_index=True)
+            best = np.sort(first)
+            
+            collected = [
+                {"score": float(flat_s[j]), "path": str(meta_paths[flat_i[j]])}
+                for j in best
+            ]
             
             sort_order = options.get("sort_order", "highest_similarity_first")
-            reverse = (sort_order == "highest_similarity_first")
-            ordered = sorted(collected.values(), key=lambda x: x["score"], reverse=reverse)
+            ordered = collected if sort_order == "highest_similarity_first" else collected[::-1]
             
             ordered = ordered[:max_results]
             
@@ -378,7 +471,7 @@ class ImageSearchParser(BaseParser):
                 "query_images": query_paths,
                 "results": results,
                 "options": options,
-                "total_indexed": len(meta),
+                "total_indexed": len(meta["paths"]),
             }
             
         except Exception as e:
@@ -388,13 +481,17 @@ class ImageSearchParser(BaseParser):
                 logger.error(traceback.format_exc())
             return None
     
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tiff", ".tif")
+    
     @classmethod
     def _gather_files(cls, search_input: bool, search_output: bool, search_temp: bool) -> list:
-        """Gather image files from ComfyUI directories."""
-        import folder_paths
+        """
+        Gather image files from ComfyUI directories.
         
-        IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tiff", ".tif"}
-        files = []
+        Returns (path, mtime) tuples; mtimes come from the cached directory
+        entry stat so indexing does not stat every file again.
+        """
+        import folder_paths
         
         dirs = []
         if search_input:
@@ -404,30 +501,47 @@ class ImageSearchParser(BaseParser):
         if search_temp:
             dirs.append(folder_paths.get_temp_directory())
         
-        for base_dir in dirs:
-            if not os.path.isdir(base_dir):
-                continue
-            for root, _, filenames in os.walk(base_dir):
-                for fname in filenames:
-                    ext = os.path.splitext(fname)[1].lower()
-                    if ext in IMAGE_EXTENSIONS:
-                        files.append(os.path.join(root, fname))
+        dirs = [d for d in dirs if os.path.isdir(d)]
+        if not dirs:
+            return []
+        
+        files = []
+        # One thread per root; scandir latency (network shares) dominates here
+        with ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+            for entries in executor.map(lambda d: _scan_image_files(d, cls.IMAGE_EXTENSIONS), dirs):
+                files.extend(entries)
         
         return files
     
     @classmethod
-    def _get_api_view_info(cls, path: str) -> dict:
-        """Get filename, subfolder, type for ComfyUI /api/view endpoint."""
+    def _api_view_roots(cls) -> tuple:
+        """ComfyUI (directory + separator, type) roots, longest first for prefix matching."""
         import folder_paths
         
+        roots = [
+            (folder_paths.get_input_directory(), "input"),
+            (folder_paths.get_output_directory(), "output"),
+            (folder_paths.get_temp_directory(), "temp"),
+        ]
+        return tuple(sorted(
+            ((os.path.join(base, ""), dir_type) for base, dir_type in roots),
+            key=lambda root: -len(root[0]),
+        ))
+    
+    @classmethod
+    def _get_api_view_info(cls, path: str, roots: tuple = None) -> dict:
+        """
+        Get filename, subfolder, type for ComfyUI /api/view endpoint.
+        
+        Pass roots from _api_view_roots() when resolving many paths.
+        """
+        if roots is None:
+            roots = cls._api_view_roots()
+        
         filename = os.path.basename(path)
         parent_dir = os.path.dirname(path)
         
-        input_dir = folder_paths.get_input_directory()
-        output_dir = folder_paths.get_output_directory()
-        temp_dir = folder_paths.get_temp_directory()
-        
-        for dir_path, dir_type in [(input_dir, "input"), (output_dir, "output"), (temp_dir, "temp")]:
+        for dir_path, dir_type in roots:
             if path.startswith(dir_path):
                 rel_path = os.path.relpath(parent_dir, dir_path)
                 subfolder = "" if rel_path == "." else rel_path
@@ -446,75 +560,50 @@ class ImageSearchParser(BaseParser):
     @classmethod
     def _gather_metrics(cls, ordered: list, brightness_split: float, logger=None) -> list:
         """Gather detailed metrics for each search result image."""
-        from PIL import Image
+        import multiprocessing
         
         results = []
+        roots = cls._api_view_roots()
+        args_list = [
+            (item["path"], item["score"], cls._get_api_view_info(item["path"], roots), brightness_split)
+            for item in ordered
+        ]
         
-        def process_image(item):
-            path = item["meta"]["path"]
-            api_info = cls._get_api_view_info(path)
-            
-            result = {
-                "path": path,
-                "filename": api_info["filename"],
-                "subfolder": api_info["subfolder"],
-                "type": api_info["type"],
-                "similarity": item["score"],
-            }
-            
+        # Decoding is GIL-bound, so spread it over forked processes on Linux.
+        # Spawned children would re-import ComfyUI's entry point and fork is
+        # unsafe on macOS, so other platforms (and small result sets) use threads.
+        use_processes = (
+            len(args_list) >= cls.METRICS_PROCESS_MIN_RESULTS
+            and sys.platform.startswith("linux")
+            and "fork" in multiprocessing.get_all_start_methods()
+        )
+        
+        if use_processes:
+            # Every worker is forked up front, so only start as many as there are chunks
+            chunksize = cls.METRICS_PROCESS_CHUNKSIZE
+            workers = min(
+                os.cpu_count() or 1,
+                cls.METRICS_PROCESS_MAX_WORKERS,
+                -(-len(args_list) // chunksize),
+            )
             try:
-                stat = os.stat(path)
-                result["file_size"] = stat.st_size
-                result["modified_time"] = stat.st_mtime
-                
-                pil = Image.open(path)
-                result["width"] = pil.width
-                result["height"] = pil.height
-                result["format"] = pil.format
-                result["mode"] = pil.mode
-                
-                pil_rgb = pil.convert("RGB")
-                
-                import numpy as np
-                arr = np.array(pil_rgb.convert("L"))
-                brightness = float(arr.mean() / 255.0)
-                result["brightness"] = brightness
-                result["is_dark"] = brightness < brightness_split
-                
-                has_workflow = False
-                has_prompt = False
-                # Check PNG metadata using direct binary parsing for reliability
-                try:
-                    if path.lower().endswith('.png'):
-                        metadata = _read_png_text_chunks(path)
-                        for key in metadata.keys():
-                            key_lower = key.lower()
-                            if key_lower == "workflow":
-                                has_workflow = bool(metadata[key])
-                            elif key_lower == "prompt":
-                                has_prompt = bool(metadata[key])
-                except Exception:
-                    pass
-                
-                result["has_workflow"] = has_workflow
-                result["has_prompt"] = has_prompt
-                
-                pil.close()
-                
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                ) as executor:
+                    results = list(executor.map(_gather_image_metrics, args_list, chunksize=chunksize))
             except Exception as e:
-                result["error"] = str(e)
-            
-            return result
+                if logger:
+                    logger.warning(f"[Image Search Parser] Process pool failed, using threads: {e}")
+                use_processes = False
         
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            futures = [executor.submit(process_image, item) for item in ordered]
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    results.append(result)
-                except Exception as e:
-                    if logger:
-                        logger.warning(f"[Image Search Parser] Failed to process image: {e}")
+        if not use_processes:
+            try:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    results = list(executor.map(_gather_image_metrics, args_list))
+            except Exception as e:
+                if logger:
+                    logger.warning(f"[Image Search Parser] Failed to process images: {e}")
         
         results.sort(key=lambda x: x.get("similarity", 0), reverse=True)
         
@@ -524,7 +613,6 @@ class ImageSearchParser(BaseParser):
     def _load_images_as_tensors(cls, image_paths: list, options: dict, logger=None):
         """Load images from paths and return as stacked tensor batch."""
         import torch
-        import numpy as np
         from PIL import Image
         
         if not image_paths:
@@ -543,28 +631,106 @@ class ImageSearchParser(BaseParser):
         }
         resample = resample_map.get(resample_str, Image.LANCZOS)
         
-        tensors = []
-        for path in image_paths:
-            try:
-                pil = Image.open(path).convert("RGB")
-                pil_out = cls._resize_pil(pil, resize_width, resize_height, resize_mode, resample)
-                t = cls._pil_to_tensor(pil_out)
-                tensors.append(t)
-            except Exception as e:
+        cls._log_pillow_simd_hint(logger)
+        
+        def decode(path):
+            pil = cls._open_rgb(path, (resize_width, resize_height))
+            pil_out = cls._resize_pil(pil, resize_width, resize_height, resize_mode, resample)
+            return cls._pil_to_tensor(pil_out)
+        
+        # Fill a preallocated batch while the next images decode in the background
+        out = None
+        count = 0
+        for path, t, error in cls._iter_decoded(image_paths, decode):
+            if error is not None:
                 if logger:
-                    logger.warning(f"[Image Search Parser] Failed to load {path}: {e}")
+                    logger.warning(f"[Image Search Parser] Failed to load {path}: {error}")
                 continue
+            if out is None:
+                out = torch.empty((len(image_paths), *t.shape), dtype=torch.uint8)
+            elif t.shape != out.shape[1:]:
+                if logger:
+                    logger.warning(f"[Image Search Parser] Skipping {path}: size {tuple(t.shape)} does not match batch {tuple(out.shape[1:])}")
+                continue
+            out[count].copy_(t)
+            count += 1
         
-        if not tensors:
+        if out is None or count == 0:
             return torch.zeros((1, 64, 64, 3))
         
-        return torch.stack(tensors, dim=0)
+        return cls._normalize_images(out[:count])
+    
+    @classmethod
+    def _iter_decoded(cls, paths: list, decode, prefetch: int = 4):
+        """
+        Yield (path, decode(path), error) in order, decoding ahead on a worker thread.
+        
+        A bounded queue keeps at most `prefetch` decoded images waiting, so
+        decoding overlaps with whatever the caller does with each result.
+        """
+        import queue
+        import threading
+        
+        q = queue.Queue(maxsize=prefetch)
+        done = object()
+        
+        def worker():
+            for path in paths:
+                try:
+                    q.put((path, decode(path), None))
+                except Exception as e:
+                    q.put((path, None, e))
+            q.put(done)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        while (item := q.get()) is not done:
+            yield item
+    
+    @classmethod
+    def _log_pillow_simd_hint(cls, logger=None):
+        """Suggest Pillow-SIMD once per process when stock Pillow is installed."""
+        if cls._pillow_simd_hint_logged:
+            return
+        cls._pillow_simd_hint_logged = True
+        
+        import PIL
+        if ".post" not in PIL.__version__ and logger:
+            logger.info("[Image Search Parser] Tip: install pillow-simd for faster image resizing")
+    
+    @classmethod
+    def _open_rgb(cls, path: str, size=None):
+        """
+        Open an image as RGB.
+        
+        When a target size is given, JPEGs are decoded with draft() at the
+        smallest DCT scale that still covers twice the target, so large
+        sources are never fully decoded just to be downscaled.
+        """
+        from PIL import Image
+        
+        pil = Image.open(path)
+        if size:
+            try:
+                pil.draft("RGB", (size[0] * 2, size[1] * 2))
+            except Exception:
+                pass
+        return pil.convert("RGB")
     
     @classmethod
     def _resize_pil(cls, pil_image, width, height, mode, resample):
         """Resize PIL image according to mode."""
         from PIL import Image
         
+        # Every mode is the identity when the source already matches the target
+        if pil_image.size == (width, height):
+            return pil_image
+        
+        # No-op unless the image is a JPEG that has not been decoded yet
+        try:
+            pil_image.draft(pil_image.mode, (width * 2, height * 2))
+        except Exception:
+            pass
+        
         if mode == "stretch":
             return pil_image.resize((width, height), resample)
         
@@ -642,18 +808,40 @@ class ImageSearchParser(BaseParser):
         return pil_image.resize((width, height), resample)
     
     @classmethod
-    def _pil_to_tensor(cls, pil_image, want_alpha=False):
-        """Convert PIL image to tensor (H, W, C) normalized 0-1."""
+    def _pil_to_tensor(cls, pil_image, want_alpha=False, dtype=None):
+        """
+        Convert PIL image to tensor (H, W, C).
+        
+        Returns raw uint8 pixels by default so batches are stacked at a quarter
+        of the size; pass a floating dtype to get values normalized 0-1.
+        
+        The uint8 tensor wraps the image bytes without a copy and must be
+        treated as read-only (stack or copy it before mutating).
+        """
         import torch
-        import numpy as np
         
         if want_alpha and pil_image.mode != "RGBA":
             pil_image = pil_image.convert("RGBA")
-        elif not want_alpha and pil_image.mode == "RGBA":
+        elif not want_alpha and pil_image.mode not in ("RGB", "L"):
             pil_image = pil_image.convert("RGB")
         
-        arr = np.array(pil_image).astype(np.float32) / 255.0
-        return torch.from_numpy(arr)
+        width, height = pil_image.size
+        channels = len(pil_image.getbands())
+        buf = pil_image.tobytes()
+        if not buf:
+            return torch.zeros((height, width, channels), dtype=dtype or torch.uint8)
+        
+        t = torch.frombuffer(buf, dtype=torch.uint8).view(height, width, channels)
+        if dtype is not None and dtype != torch.uint8:
+            t = t.to(dtype).div_(255.0)
+        return t
+    
+    @classmethod
+    def _normalize_images(cls, batch):
+        """Convert a uint8 (B, H, W, C) batch to float32 normalized 0-1."""
+        import torch
+        
+        return batch.to(torch.float32).div_(255.0)
 
 
 def send_progress(value: int, max_value: int, text: str = ""):
@@ -673,12 +861,50 @@ def send_progress(value: int, max_value: int, text: str = ""):
 class ImageSearchEngine:
     """CLIP-based image search engine with caching."""
     
+    # On-disk storage types for the embedding index
+    INDEX_DTYPES = {
+        "fp32": "float32",
+        "fp16": "float16",
+        "int8": "int8",
+    }
+    
+    # Galleries this large switch from exact search to a trained IVFPQ index
+    IVFPQ_MIN_VECTORS = 50000
+    IVFPQ_SUBQUANTIZERS = 32
+    IVFPQ_MAX_TRAIN_VECTORS = 100000
+    
+    # Indexing runs at least this many batches long amortize torch.compile warmup
+    COMPILE_MIN_BATCHES = 16
+    
+    # Forking the ComfyUI process (CUDA context, model, threads) for DataLoader
+    # workers only pays off for large indexing runs; smaller ones decode on threads
+    LOADER_PROCESS_MIN_IMAGES = 256
+    LOADER_PROCESS_MAX_WORKERS = 8
+    
+    # FAISS GPU scratch memory, shared by the engines created for each search
+    _gpu_resources = None
+    # fp16 device copy of the last searched vectors as (version, tensor); a new
+    # engine is built per search, so this lives on the class to be reused
+    _gpu_index = None
+    # GPU FAISS copy of the last searched index as (version, index or None)
+    _gpu_faiss_index = None
+    # Largest k GPU FAISS can select (GPU_MAX_SELECTION_K: 2048, 1024 on older builds)
+    FAISS_GPU_MAX_K = 1024
+    # Cap on the scratch pool StandardGpuResources reserves (FAISS defaults to ~1.5 GiB)
+    FAISS_GPU_TEMP_MEMORY = 256 * 1024 * 1024
+    _comfy_hook_installed = False
+    
     def __init__(self, model_id: str, logger=None):
         self.model_id = model_id
         self.logger = logger
         self.model = None
         self.processor = None
         self.device = None
+        self.input_size = 224
+        self.pixel_mean = None
+        self.pixel_std = None
+        self.copy_stream = None
+        self._compiled = False
         self._load_model()
     
     def _load_model(self):
@@ -691,10 +917,53 @@ class ImageSearchEngine:
         if self.logger:
             self.logger.info(f"[ImageSearchEngine] Loading {self.model_id} on {self.device}")
         
-        self.model = CLIPModel.from_pretrained(self.model_id)
+        # Half-precision weights on CUDA; features are cast back to fp32 after the forward
+        dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.model = CLIPModel.from_pretrained(self.model_id, torch_dtype=dtype)
         self.processor = CLIPProcessor.from_pretrained(self.model_id)
         self.model.to(self.device)
         self.model.eval()
+        
+        # Preprocessing constants, applied on the device in _upload_batch
+        image_processor = getattr(self.processor, "image_processor", None) or self.processor.feature_extractor
+        crop_size = image_processor.crop_size
+        self.input_size = crop_size["height"] if isinstance(crop_size, dict) else int(crop_size)
+        self.pixel_mean = torch.tensor(image_processor.image_mean, device=self.device).view(1, 3, 1, 1)
+        self.pixel_std = torch.tensor(image_processor.image_std, device=self.device).view(1, 3, 1, 1)
+        
+        # Side stream for host->device copies so the next batch uploads while CLIP runs
+        if self.device == "cuda":
+            self.copy_stream = torch.cuda.Stream()
+            # Batches arrive as permuted NHWC buffers, i.e. already channels_last;
+            # match the patch-embedding conv weights so cuDNN skips the relayout
+            self.model.to(memory_format=torch.channels_last)
+    
+    def _compile_vision_model(self):
+        """Wrap the CLIP vision tower in torch.compile on CUDA (no-op if unavailable)."""
+        import torch
+        
+        if self._compiled or self.device != "cuda" or not hasattr(torch, "compile"):
+            return
+        self._compiled = True
+        try:
+            self.model.vision_model = torch.compile(self.model.vision_model)
+        except Exception as e:
+            if self.logger:
+                self.logger.warning(f"[ImageSearchEngine] torch.compile unavailable: {e}")
+    
+    def _image_features(self, pixel_values):
+        """CLIP image features, dropping back to eager mode if the compiled tower fails."""
+        try:
+            return self.model.get_image_features(pixel_values=pixel_values)
+        except Exception as e:
+            # Compilation is lazy, so backend errors (e.g. no Triton) surface on the first call
+            vision_model = getattr(self.model.vision_model, "_orig_mod", None)
+            if vision_model is None:
+                raise
+            if self.logger:
+                self.logger.warning(f"[ImageSearchEngine] Compiled CLIP failed, using eager mode: {e}")
+            self.model.vision_model = vision_model
+            return self.model.get_image_features(pixel_values=pixel_values)
     
     def _get_cache_paths(self):
         """Get cache file paths in ComfyUI_Viewer/.cache/image_search."""
@@ -709,11 +978,14 @@ class ImageSearchEngine:
         model_hash = hashlib.md5(self.model_id.encode()).hexdigest()[:8]
         return {
             "index": os.path.join(cache_dir, f"index_{model_hash}.npy"),
-            "meta": os.path.join(cache_dir, f"meta_{model_hash}.json"),
+            "meta": os.path.join(cache_dir, f"meta_{model_hash}.npz"),
+            "legacy_meta": os.path.join(cache_dir, f"meta_{model_hash}.json"),
+            "faiss": os.path.join(cache_dir, f"index_{model_hash}.faiss"),
         }
     
     def clear_cache(self):
         """Clear cached index and metadata."""
+        ImageSearchEngine.release_gpu_caches()
         paths = self._get_cache_paths()
         for p in paths.values():
             if os.path.exists(p):
@@ -722,244 +994,990 @@ class ImageSearchEngine:
                 except Exception:
                     pass
     
-    def update_index(self, files: list, index_threads: int = 8, embed_batch_size: int = 64):
-        """Update FAISS index with new files."""
+    def update_index(self, files: list, index_threads: int = 8, embed_batch_size: int = 64, index_dtype: str = "fp16", mtimes: list = None):
+        """
+        Update FAISS index with new files.
+        
+        mtimes, when given, are the files' modification times (parallel to
+        files) and save a stat call per file.
+        """
         import numpy as np
-        from PIL import Image
         
         paths = self._get_cache_paths()
         
         # Load existing
-        existing_meta = []
-        existing_vecs = None
-        if os.path.exists(paths["meta"]):
-            try:
-                with open(paths["meta"], "r") as f:
-                    existing_meta = json.load(f)
-            except Exception:
-                existing_meta = []
-        
-        existing_paths = {m["path"]: i for i, m in enumerate(existing_meta)}
+        existing_meta = self._load_meta(paths)
+        stored_paths = existing_meta["paths"]
         
-        # Find new files
-        new_files = []
-        for f in files:
-            if f not in existing_paths:
-                new_files.append(f)
+        # Find new files: latest indexed mtime per path, looked up with searchsorted
+        files_arr = np.array(files, dtype=str)
+        if len(stored_paths) and len(files_arr):
+            order = np.argsort(stored_paths, kind="stable")
+            sorted_paths = stored_paths[order]
+            uniq_paths, starts = np.unique(sorted_paths, return_index=True)
+            latest_mtimes = np.maximum.reduceat(existing_meta["mtimes"][order], starts)
+            
+            pos = np.minimum(np.searchsorted(uniq_paths, files_arr), len(uniq_paths) - 1)
+            known = uniq_paths[pos] == files_arr
+            new_mask = ~known
+            
+            # Check if modified
+            known_idx = np.flatnonzero(known)
+            if mtimes is not None:
+                file_mtimes = np.asarray(mtimes, dtype=np.float64)[known_idx]
             else:
-                # Check if modified
-                try:
-                    mtime = os.path.getmtime(f)
-                    if mtime > existing_meta[existing_paths[f]].get("mtime", 0):
-                        new_files.append(f)
-                except Exception:
-                    pass
+                file_mtimes = np.array([_safe_mtime(files[i], default=-np.inf) for i in known_idx], dtype=np.float64)
+            new_mask[known_idx] = file_mtimes > latest_mtimes[pos[known_idx]]
+            new_files = [files[i] for i in np.flatnonzero(new_mask)]
+        else:
+            new_files = list(files)
         
         if self.logger:
             self.logger.info(f"[ImageSearchEngine] {len(new_files)} new/modified files to index")
         
-        # Load images in parallel
-        def load_image(path):
-            try:
-                pil = Image.open(path).convert("RGB")
-                return (path, pil)
-            except Exception:
-                return None
+        existing_vecs = self._load_vecs(paths["index"])
         
-        new_pils = []
-        new_paths = []
+        # Content keys of already embedded rows, so identical bytes under another
+        # path (copies, re-downloads, touched files) reuse the stored vector
+        known_rows = len(existing_vecs) if existing_vecs is not None else 0
+        key_rows = {}
+        if new_files:
+            for i, key in enumerate(existing_meta["keys"][:known_rows].tolist()):
+                if key:
+                    key_rows.setdefault(key, i)
+        
+        # Hash new files in parallel; only the first path per unseen key gets decoded
+        hashed_paths = []
+        hashed_keys = []
+        embed_paths = []
+        embed_slots = {}
         
         if self.logger and new_files:
-            self.logger.info(f"[ImageSearchEngine] Loading {len(new_files)} images...")
+            self.logger.info(f"[ImageSearchEngine] Hashing {len(new_files)} images...")
+        
+        def hash_file(path):
+            try:
+                return _content_key(path)
+            except Exception:
+                return None
         
         with ThreadPoolExecutor(max_workers=index_threads) as executor:
-            futures = list(executor.map(load_image, new_files))
-            for i, result in enumerate(futures):
-                if result:
-                    new_paths.append(result[0])
-                    new_pils.append(result[1])
-                # Update progress for loading phase (0-50%)
+            for i, (path, key) in enumerate(zip(new_files, executor.map(hash_file, new_files))):
+                if key is not None:
+                    hashed_paths.append(path)
+                    hashed_keys.append(key)
+                    if key not in key_rows and key not in embed_slots:
+                        embed_slots[key] = len(embed_paths)
+                        embed_paths.append(path)
+                # Update progress for hashing phase (0-50%)
                 if i % 10 == 0 or i == len(new_files) - 1:
                     send_progress(i + 1, len(new_files) * 2)
         
-        # Embed new images
-        new_vecs = None
-        if new_pils:
+        # Decode and embed as a stream so only a few batches are in memory at once
+        embedded = None
+        embedded_rows = {}
+        if embed_paths:
             if self.logger:
-                self.logger.info(f"[ImageSearchEngine] Embedding {len(new_pils)} images...")
-            new_vecs = self.embed_pils(new_pils, batch_size=embed_batch_size, total_for_progress=len(new_files))
+                self.logger.info(f"[ImageSearchEngine] Embedding {len(embed_paths)} images ({len(hashed_paths) - len(embed_paths)} reused by content)...")
+            
+            loaded = []
+            
+            def pixel_batches():
+                for positions, pixel_values in self._image_loader(embed_paths, embed_batch_size, index_threads):
+                    if pixel_values is not None:
+                        loaded.extend(positions)
+                        yield pixel_values
+            
+            num_batches = (len(embed_paths) + embed_batch_size - 1) // embed_batch_size
+            embedded = self.embed_batches(pixel_batches(), num_batches, total_for_progress=len(new_files))
+            embedded_rows = {embed_paths[pos]: row for row, pos in enumerate(loaded)}
+        
+        # Keep hashed files that were either reused or decoded successfully
+        new_paths = []
+        new_keys = []
+        # Per new path: ("row", existing row) or ("embed", row in embedded)
+        new_sources = []
+        for path, key in zip(hashed_paths, hashed_keys):
+            if key in key_rows:
+                new_sources.append(("row", key_rows[key]))
+            else:
+                row = embedded_rows.get(embed_paths[embed_slots[key]])
+                if row is None:
+                    continue
+                new_sources.append(("embed", row))
+            new_paths.append(path)
+            new_keys.append(key)
+        
+        new_vecs = None
+        if new_paths:
+            dim = embedded.shape[1] if embedded is not None and len(embedded) else existing_vecs.shape[1]
+            new_vecs = np.empty((len(new_paths), dim), dtype=np.float32)
+            for i, (source, idx) in enumerate(new_sources):
+                new_vecs[i] = embedded[idx] if source == "embed" else existing_vecs[idx]
+            # Reused rows may come from int8 or legacy storage; keep everything unit length
+            new_vecs /= np.maximum(np.linalg.norm(new_vecs, axis=1, keepdims=True), 1e-12)
             
             # Add to metadata
-            for i, path in enumerate(new_paths):
-                try:
-                    mtime = os.path.getmtime(path)
-                except Exception:
-                    mtime = 0
-                existing_meta.append({"path": path, "mtime": mtime})
+            file_mtimes = dict(zip(files, mtimes)) if mtimes is not None else {}
+            new_mtimes = [file_mtimes[p] if p in file_mtimes else _safe_mtime(p) for p in new_paths]
+            existing_meta = {
+                "paths": np.concatenate([stored_paths, np.array(new_paths, dtype=str)]),
+                "mtimes": np.concatenate([existing_meta["mtimes"], np.array(new_mtimes, dtype=np.float64)]),
+                "keys": np.concatenate([existing_meta["keys"], np.array(new_keys, dtype=str)]),
+            }
         
         # Combine vectors
-        if os.path.exists(paths["index"]):
-            try:
-                existing_vecs = np.load(paths["index"])
-            except Exception:
-                existing_vecs = None
-        
-        if existing_vecs is not None and new_vecs is not None:
-            all_vecs = np.vstack([existing_vecs, new_vecs])
-        elif new_vecs is not None:
-            all_vecs = new_vecs
+        storage_dtype = np.dtype(self.INDEX_DTYPES.get(index_dtype, "float16"))
+        # Caches written before embeddings were stored normalized get normalized once here
+        legacy_rows = existing_vecs is not None and not self._rows_normalized(existing_vecs)
+        # Re-encoded rows change value, so a persisted FAISS index no longer matches them
+        reencoded = legacy_rows or (existing_vecs is not None and existing_vecs.dtype != storage_dtype)
+        existing_count = len(existing_vecs) if existing_vecs is not None else 0
+        new_count = len(new_vecs) if new_vecs is not None else 0
+        if new_vecs is not None or reencoded:
+            # Grow (or re-encode) the on-disk index into a fresh memmap and swap
+            # it in, so existing rows are streamed from disk instead of loaded into RAM
+            dim = new_vecs.shape[1] if new_vecs is not None else existing_vecs.shape[1]
+            tmp_path = paths["index"] + ".tmp"
+            grown = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=storage_dtype,
+                shape=(existing_count + new_count, dim),
+            )
+            if existing_count:
+                if existing_vecs.dtype == storage_dtype and not legacy_rows:
+                    grown[:existing_count] = existing_vecs
+                else:
+                    for start, block in self._float_blocks(existing_vecs, normalize=True):
+                        grown[start:start + len(block)] = self._encode_vecs(block, storage_dtype)
+            if new_count:
+                grown[existing_count:] = self._encode_vecs(new_vecs, storage_dtype)
+            grown.flush()
+            # Release both maps before replacing (required on Windows)
+            del grown, existing_vecs
+            os.replace(tmp_path, paths["index"])
+            all_vecs = self._load_vecs(paths["index"])
         elif existing_vecs is not None:
             all_vecs = existing_vecs
         else:
-            all_vecs = np.zeros((0, 512), dtype=np.float32)
+            all_vecs = np.zeros((0, 512), dtype=storage_dtype)
+            np.save(paths["index"], all_vecs)
         
-        # Save
-        np.save(paths["index"], all_vecs)
-        with open(paths["meta"], "w") as f:
-            json.dump(existing_meta, f)
+        if new_vecs is not None or not os.path.exists(paths["meta"]):
+            np.savez(paths["meta"], **existing_meta)
         
         # Build FAISS index
         try:
             import faiss
-            dim = all_vecs.shape[1] if len(all_vecs) > 0 else 512
-            index = faiss.IndexFlatIP(dim)
-            all_vecs_normalized = all_vecs.copy()
-            if len(all_vecs_normalized) > 0:
-                faiss.normalize_L2(all_vecs_normalized)
-                index.add(all_vecs_normalized)
-            return index, all_vecs, existing_meta
         except ImportError:
             # Fallback without FAISS - return vectors as index
             return None, all_vecs, existing_meta
+        
+        if self.device == "cuda" and not hasattr(faiss, "StandardGpuResources"):
+            # CPU-only FAISS on a CUDA machine: search() runs on the GPU through
+            # torch and would never query a CPU index, so don't build or train one
+            return None, all_vecs, existing_meta
+        
+        index = None
+        if not reencoded and os.path.exists(paths["faiss"]):
+            try:
+                if new_vecs is None:
+                    # IO_FLAG_MMAP only maps IVF inverted lists; flat indexes need
+                    # IO_FLAG_MMAP_IFC (newer FAISS) or are read fully into RAM
+                    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+                    index = faiss.read_index(paths["faiss"], flags)
+                    if index.ntotal != len(all_vecs):
+                        index = None
+                else:
+                    # Append only the new rows when the persisted index covers
+                    # exactly the existing ones and still suits the gallery size
+                    index = faiss.read_index(paths["faiss"])
+                    if index.ntotal != existing_count or not self._faiss_index_fits(index, len(all_vecs)):
+                        index = None
+                    else:
+                        for _, block in self._float_blocks(all_vecs[existing_count:]):
+                            index.add(block)
+                        self._write_faiss_index(index, paths["faiss"])
+            except Exception:
+                index = None
+        
+        if index is None:
+            index = self._new_faiss_index(all_vecs)
+            # Upcast in slices to avoid a full fp32 copy of the index
+            for _, block in self._float_blocks(all_vecs):
+                index.add(block)
+            self._write_faiss_index(index, paths["faiss"])
+        
+        return index, all_vecs, existing_meta
+    
+    def _write_faiss_index(self, index, path: str):
+        """
+        Persist a FAISS index, logging instead of failing the search.
+        
+        Writes a temp file and swaps it in, so indexes still memory-mapped
+        from the previous file keep reading intact data.
+        """
+        import faiss
+        
+        tmp_path = path + ".tmp"
+        try:
+            faiss.write_index(index, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            if self.logger:
+                self.logger.warning(f"[ImageSearchEngine] Failed to persist FAISS index: {e}")
+    
+    def _faiss_index_fits(self, index, count: int) -> bool:
+        """
+        Whether a persisted index can keep absorbing rows at this gallery size.
+        
+        Flat indexes are replaced once the gallery reaches IVFPQ_MIN_VECTORS,
+        and IVF indexes are retrained once the gallery outgrows their nlist by 2x.
+        """
+        import faiss
+        import numpy as np
+        
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except Exception:
+            return count < self.IVFPQ_MIN_VECTORS or index.d % self.IVFPQ_SUBQUANTIZERS != 0
+        return ivf.nlist * 2 >= int(4 * np.sqrt(count))
+    
+    def _new_faiss_index(self, all_vecs):
+        """
+        Create an empty FAISS index sized for all_vecs.
+        
+        Small galleries use exact IndexFlatIP. From IVFPQ_MIN_VECTORS rows on,
+        an IVF + PQ index (32 bytes per vector, sub-linear search) is trained
+        on a sample of the normalized vectors.
+        """
+        import faiss
+        import numpy as np
+        
+        dim = all_vecs.shape[1] if all_vecs.ndim == 2 else 512
+        count = len(all_vecs)
+        if count < self.IVFPQ_MIN_VECTORS or dim % self.IVFPQ_SUBQUANTIZERS:
+            return faiss.IndexFlatIP(dim)
+        
+        nlist = int(4 * np.sqrt(count))
+        if self.logger:
+            self.logger.info(f"[ImageSearchEngine] Training IVF{nlist},PQ{self.IVFPQ_SUBQUANTIZERS}x8 index for {count} vectors")
+        index = faiss.index_factory(dim, f"IVF{nlist},PQ{self.IVFPQ_SUBQUANTIZERS}x8", faiss.METRIC_INNER_PRODUCT)
+        
+        sample_size = min(count, self.IVFPQ_MAX_TRAIN_VECTORS)
+        rows = np.sort(np.random.default_rng(0).choice(count, sample_size, replace=False))
+        sample = np.array(all_vecs[rows], dtype=np.float32)
+        if all_vecs.dtype == np.int8:
+            faiss.normalize_L2(sample)
+        index.train(sample)
+        return index
+    
+    @staticmethod
+    def _set_nprobe(index):
+        """Set the IVF probe count for an index; no-op for flat indexes."""
+        import faiss
+        
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except Exception:
+            return
+        ivf.nprobe = max(8, ivf.nlist // 32)
+    
+    @staticmethod
+    def _encode_vecs(vecs, dtype):
+        """
+        Convert float vectors to the index storage dtype.
+        
+        int8 rows are scaled so their largest component maps to 127. Search
+        is cosine similarity, so the per-row scale does not need to be kept.
+        """
+        import numpy as np
+        
+        if dtype != np.int8:
+            return vecs.astype(dtype)
+        scale = np.abs(vecs).max(axis=1, keepdims=True) / 127.0
+        scale[scale == 0] = 1.0
+        return np.clip(np.round(vecs / scale), -127, 127).astype(np.int8)
+    
+    @staticmethod
+    def _float_blocks(vecs, block_rows: int = 65536, normalize: bool = False):
+        """
+        Yield (start, float32 copy) slices of a stored vector array.
+        
+        Float storage already holds unit-length rows. int8 rows are scaled,
+        so they (and anything passed with normalize=True) are normalized per block.
+        """
+        import numpy as np
+        
+        normalize = normalize or vecs.dtype == np.int8
+        for start in range(0, len(vecs), block_rows):
+            block = np.array(vecs[start:start + block_rows], dtype=np.float32)
+            if normalize:
+                block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+            yield start, block
+    
+    @staticmethod
+    def _rows_normalized(vecs, sample_rows: int = 256) -> bool:
+        """Check a sample of stored rows for unit length (int8 storage always passes)."""
+        import numpy as np
+        
+        if vecs.dtype == np.int8 or len(vecs) == 0:
+            return True
+        rows = np.linspace(0, len(vecs) - 1, min(sample_rows, len(vecs))).astype(np.int64)
+        norms = np.linalg.norm(np.array(vecs[rows], dtype=np.float32), axis=1)
+        return bool(np.allclose(norms, 1.0, atol=1e-2))
+    
+    @staticmethod
+    def _load_meta(paths: dict) -> dict:
+        """
+        Load index metadata as parallel arrays (paths, mtimes, keys).
+        
+        Row i of every array describes row i of the vector index. Falls back
+        to the legacy list-of-dicts JSON sidecar so old caches keep working.
+        """
+        import numpy as np
+        
+        if os.path.exists(paths["meta"]):
+            try:
+                with np.load(paths["meta"], allow_pickle=False) as data:
+                    return {name: data[name] for name in ("paths", "mtimes", "keys")}
+            except Exception:
+                pass
+        
+        rows = []
+        if os.path.exists(paths["legacy_meta"]):
+            try:
+                with open(paths["legacy_meta"], "r") as f:
+                    rows = json.load(f)
+            except Exception:
+                rows = []
+        
+        return {
+            "paths": np.array([m["path"] for m in rows], dtype=str),
+            "mtimes": np.array([m.get("mtime", 0) for m in rows], dtype=np.float64),
+            "keys": np.array([m.get("key", "") for m in rows], dtype=str),
+        }
+    
+    @staticmethod
+    def _load_vecs(path: str):
+        """Open a saved vector file memory-mapped, or None if unavailable."""
+        import numpy as np
+        
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, mmap_mode="r")
+        except Exception:
+            pass
+        try:
+            # Empty arrays cannot be memory-mapped
+            return np.load(path)
+        except Exception:
+            return None
+    
+    def prepare_pil(self, pil_image):
+        """
+        Resize (shortest side, bicubic) and center crop to the CLIP input size.
+        
+        Same geometry as the CLIP processor, done once at load time so only
+        input-sized images are kept in memory and batches skip the processor.
+        """
+        return _center_crop(pil_image, self.input_size)
+    
+    def _image_loader(self, paths: list, batch_size: int, workers: int):
+        """
+        Yield (positions, uint8 NCHW batch) for paths, decoded ahead of the consumer.
+        
+        Uses a torch DataLoader with forked worker processes on Linux for runs
+        of LOADER_PROCESS_MIN_IMAGES or more, and a thread pool keeping a
+        couple of batches in flight otherwise (spawned workers would re-import
+        ComfyUI). Batches are None when every image in them failed to decode.
+        """
+        dataset = ImagePathDataset(paths, self.input_size)
+        workers = max(1, min(workers, len(paths)))
+        
+        if sys.platform.startswith("linux") and len(paths) >= self.LOADER_PROCESS_MIN_IMAGES:
+            # Every worker is a fork of the whole process; no more than there are batches
+            num_batches = (len(paths) + batch_size - 1) // batch_size
+            process_workers = min(workers, self.LOADER_PROCESS_MAX_WORKERS, num_batches)
+            started = False
+            try:
+                from torch.utils.data import DataLoader
+                
+                loader = DataLoader(
+                    dataset,
+                    batch_size=batch_size,
+                    num_workers=process_workers,
+                    collate_fn=_collate_images,
+                    pin_memory=self.copy_stream is not None,
+                    prefetch_factor=2,
+                    multiprocessing_context="fork",
+                )
+                for batch in loader:
+                    started = True
+                    yield batch
+                return
+            except Exception as e:
+                # Only fall back if the workers never produced anything
+                if started:
+                    raise
+                if self.logger:
+                    self.logger.warning(f"[ImageSearchEngine] DataLoader unavailable, decoding with threads: {e}")
+        
+        yield from _threaded_batches(dataset, batch_size, workers)
+    
+    def _upload_batch(self, batch):
+        """Start the transfer of a uint8 NCHW batch (or list of PILs) to the model device."""
+        import torch
+        import numpy as np
+        
+        if isinstance(batch, torch.Tensor):
+            pixel_values = batch
+        else:
+            arr = np.stack([np.asarray(self.prepare_pil(pil.convert("RGB"))) for pil in batch])
+            pixel_values = torch.from_numpy(arr).permute(0, 3, 1, 2)
+        
+        if self.copy_stream is None:
+            return pixel_values.to(self.device)
+        
+        # uint8 keeps the pinned buffer and the copy at a quarter of fp32
+        if not pixel_values.is_pinned():
+            pixel_values = pixel_values.pin_memory()
+        with torch.cuda.stream(self.copy_stream):
+            return pixel_values.to(self.device, non_blocking=True)
+    
+    def _normalize_pixels(self, pixel_values):
+        """Scale uint8 pixels to 0-1 and apply the CLIP mean/std on the device."""
+        import torch
+        
+        return pixel_values.to(torch.float32).div_(255.0).sub_(self.pixel_mean).div_(self.pixel_std)
     
     def embed_pils(self, pil_images: list, batch_size: int = 64, total_for_progress: int = 0):
         """Embed PIL images using CLIP."""
+        batches = [pil_images[i:i + batch_size] for i in range(0, len(pil_images), batch_size)]
+        return self.embed_batches(iter(batches), len(batches), total_for_progress or len(pil_images))
+    
+    def embed_batches(self, batches, num_batches: int, total_for_progress: int = 0):
+        """Embed an iterator of image batches (uint8 NCHW tensors or PIL lists) using CLIP."""
         import torch
         import numpy as np
         
         all_vecs = []
-        total = total_for_progress or len(pil_images)
-        num_batches = (len(pil_images) + batch_size - 1) // batch_size
+        total = max(total_for_progress, 1)
+        num_batches = max(num_batches, 1)
+        if num_batches >= self.COMPILE_MIN_BATCHES:
+            self._compile_vision_model()
+        
+        first = next(batches, None)
+        pending = self._upload_batch(first) if first is not None else None
+        batch_idx = 0
         
-        for batch_idx, i in enumerate(range(0, len(pil_images), batch_size)):
-            batch = pil_images[i:i + batch_size]
-            inputs = self.processor(images=batch, return_tensors="pt", padding=True)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        while pending is not None:
+            pixel_values = pending
+            if self.copy_stream is not None:
+                current = torch.cuda.current_stream()
+                current.wait_stream(self.copy_stream)
+                pixel_values.record_stream(current)
             
-            with torch.no_grad():
-                outputs = self.model.get_image_features(**inputs)
-                vecs = outputs.cpu().numpy()
+            with torch.inference_mode(), torch.autocast(
+                device_type="cuda", dtype=torch.float16, enabled=self.device == "cuda"
+            ):
+                pixel_values = self._normalize_pixels(pixel_values)
+                outputs = self._image_features(pixel_values).float()
             
+            # Queue the next batch's preprocessing and upload while this forward runs
+            next_batch = next(batches, None)
+            pending = self._upload_batch(next_batch) if next_batch is not None else None
+            
+            vecs = outputs.cpu().numpy()
             all_vecs.append(vecs)
             
             # Update progress for embedding phase (50-100%)
-            progress = total + int((batch_idx + 1) / num_batches * total)
+            batch_idx += 1
+            progress = total + int(min(batch_idx / num_batches, 1.0) * total)
             send_progress(progress, total * 2)
         
-        return np.vstack(all_vecs) if all_vecs else np.zeros((0, 512), dtype=np.float32)
+        if not all_vecs:
+            return np.zeros((0, 512), dtype=np.float32)
+        
+        # L2-normalize the whole result in one pass
+        vecs = np.vstack(all_vecs)
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        return vecs
+    
+    def _faiss_gpu_index(self, index, index_vecs):
+        """Return a GPU copy of a FAISS index, or None when GPU FAISS is unavailable."""
+        import faiss
+        
+        if self.device != "cuda" or not hasattr(faiss, "StandardGpuResources"):
+            return None
+        
+        vecs_version = self._vecs_version(index_vecs)
+        version = (vecs_version, type(index).__name__, index.ntotal) if vecs_version is not None else None
+        cached = ImageSearchEngine._gpu_faiss_index
+        if version is None or cached is None or cached[0] != version:
+            ImageSearchEngine._gpu_faiss_index = None
+            try:
+                if ImageSearchEngine._gpu_resources is None:
+                    resources = faiss.StandardGpuResources()
+                    resources.setTempMemory(self.FAISS_GPU_TEMP_MEMORY)
+                    ImageSearchEngine._gpu_resources = resources
+                gpu_index = faiss.index_cpu_to_gpu(ImageSearchEngine._gpu_resources, 0, index)
+                self._install_comfy_release_hook()
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning(f"[ImageSearchEngine] GPU FAISS unavailable: {e}")
+                gpu_index = None
+            ImageSearchEngine._gpu_faiss_index = cached = (version, gpu_index)
+        return cached[1]
+    
+    def _torch_gpu_search(self, query_vecs, index_vecs, top_k: int):
+        """Brute-force inner product + top-k on the GPU against a cached device copy of the index."""
+        import torch
+        
+        version = self._vecs_version(index_vecs)
+        cached = ImageSearchEngine._gpu_index
+        if version is None or cached is None or cached[0] != version:
+            # Free the stale copy first, then upload rows as fp16, block by block
+            ImageSearchEngine._gpu_index = None
+            gpu_index = torch.empty(index_vecs.shape, dtype=torch.float16, device=self.device)
+            for start, block in self._float_blocks(index_vecs):
+                gpu_index[start:start + len(block)].copy_(torch.from_numpy(block), non_blocking=False)
+            ImageSearchEngine._gpu_index = cached = (version, gpu_index)
+            self._install_comfy_release_hook()
+        gpu_index = cached[1]
+        
+        k = min(top_k, gpu_index.shape[0])
+        with torch.inference_mode():
+            q = torch.from_numpy(query_vecs).to(self.device, dtype=torch.float16)
+            scores, ids = (q @ gpu_index.T).float().topk(k, dim=-1)
+        return scores.cpu().numpy(), ids.cpu().numpy()
+    
+    @classmethod
+    def release_gpu_caches(cls):
+        """Drop the class-level device index copies and FAISS GPU resources."""
+        had_cache = cls._gpu_index is not None or cls._gpu_faiss_index is not None or cls._gpu_resources is not None
+        cls._gpu_index = None
+        cls._gpu_faiss_index = None
+        cls._gpu_resources = None
+        if had_cache:
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+    
+    @classmethod
+    def _install_comfy_release_hook(cls):
+        """
+        Release the GPU caches whenever ComfyUI unloads all models.
+        
+        These caches are invisible to ComfyUI's model management, so "Free
+        model and node cache" (and anything else calling unload_all_models)
+        has to drop them too. Installed once, on first use of a GPU cache.
+        """
+        if cls._comfy_hook_installed:
+            return
+        cls._comfy_hook_installed = True
+        try:
+            import comfy.model_management as model_management
+        except ImportError:
+            return
+        
+        unload_all_models = model_management.unload_all_models
+        
+        def unload_all_models_and_search_caches(*args, **kwargs):
+            cls.release_gpu_caches()
+            return unload_all_models(*args, **kwargs)
+        
+        model_management.unload_all_models = unload_all_models_and_search_caches
+    
+    def _vecs_version(self, index_vecs):
+        """
+        Identify the stored vectors behind index_vecs, or None if they are not on disk.
+        
+        update_index swaps in a new file whenever rows change, so the file's
+        inode, mtime and size change with it.
+        """
+        try:
+            st = os.stat(self._get_cache_paths()["index"])
+        except OSError:
+            return None
+        return (self.model_id, st.st_ino, st.st_mtime_ns, st.st_size, len(index_vecs))
     
     def search(self, query_vecs, index, index_vecs, top_k: int = 64):
         """Search the index using pre-built index and vectors."""
         import numpy as np
         
+        query_vecs = np.array(query_vecs, dtype=np.float32)
+        query_vecs /= np.maximum(np.linalg.norm(query_vecs, axis=1, keepdims=True), 1e-12)
+        
+        if index_vecs is None or len(index_vecs) == 0:
+            return np.zeros((query_vecs.shape[0], top_k), dtype=np.float32), np.full((query_vecs.shape[0], top_k), -1, dtype=np.int64)
+        
+        if index is not None:
+            self._set_nprobe(index)
+        
+        if self.device == "cuda":
+            # GPU FAISS rejects k above its selection limit; torch topk has none
+            gpu_index = None
+            if index is not None and top_k <= self.FAISS_GPU_MAX_K:
+                gpu_index = self._faiss_gpu_index(index, index_vecs)
+            if gpu_index is not None:
+                return self._exact_scores(query_vecs, index, index_vecs, *gpu_index.search(query_vecs, top_k))
+            return self._torch_gpu_search(query_vecs, index_vecs, top_k)
+        
+        if index is not None:
+            return self._exact_scores(query_vecs, index, index_vecs, *index.search(query_vecs, top_k))
+        
+        # Brute force without FAISS: upcast fp16/int8 storage block by block,
+        # keep each block's top-k and merge, so the full score matrix never exists
+        top_k = min(top_k, len(index_vecs))
+        block_scores = []
+        block_ids = []
+        for start, block in self._float_blocks(index_vecs):
+            scores, ids = self._select_topk(query_vecs @ block.T, min(top_k, len(block)))
+            block_scores.append(scores)
+            block_ids.append(ids + start)
+        
+        if len(block_scores) == 1:
+            return block_scores[0], block_ids[0]
+        return self._select_topk(np.hstack(block_scores), top_k, np.hstack(block_ids))
+    
+    @staticmethod
+    def _exact_scores(query_vecs, index, index_vecs, scores, ids):
+        """
+        Re-score IVFPQ candidates exactly against the stored vectors.
+        
+        PQ inner products are approximations, but scores are thresholded and
+        shown as the similarity, so the returned ids (top_k rows per query)
+        are re-scored and re-sorted. Exact (flat) index results pass through.
+        """
+        import faiss
+        import numpy as np
+        
         try:
-            import faiss
-            
-            query_vecs_copy = query_vecs.copy()
-            faiss.normalize_L2(query_vecs_copy)
-            scores, ids = index.search(query_vecs_copy, top_k)
+            faiss.extract_index_ivf(index)
+        except Exception:
             return scores, ids
+        
+        exact = np.full(ids.shape, -np.inf, dtype=np.float32)
+        for q in range(ids.shape[0]):
+            valid = np.flatnonzero(ids[q] >= 0)
+            if not len(valid):
+                continue
+            # Sorted row order keeps memmap reads sequential
+            rows, inverse = np.unique(ids[q, valid], return_inverse=True)
+            vecs = np.array(index_vecs[rows], dtype=np.float32)
+            vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+            exact[q, valid] = (vecs @ query_vecs[q])[inverse]
+        
+        order = np.argsort(-exact, axis=1, kind="stable")
+        return np.take_along_axis(exact, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    
+    @staticmethod
+    def _select_topk(scores, top_k: int, ids=None):
+        """Sorted top-k (scores, ids) per row of a score matrix; ids maps columns to row ids."""
+        import numpy as np
+        
+        if scores.shape[1] <= top_k * 2:
+            cols = np.argsort(-scores, axis=1)[:, :top_k]
+        else:
+            # O(N) selection of the top-k, then sort only that slice
+            part = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+            cols = np.take_along_axis(part, order, axis=1)
+        
+        top_ids = cols if ids is None else np.take_along_axis(ids, cols, axis=1)
+        return np.take_along_axis(scores, cols, axis=1), top_ids.astype(np.int64, copy=False)
+
+
+class ImagePathDataset:
+    """Map-style dataset decoding image paths to CLIP-sized uint8 HWC arrays (None on failure)."""
+    
+    def __init__(self, paths: list, input_size: int):
+        self.paths = paths
+        self.input_size = input_size
+    
+    def __len__(self):
+        return len(self.paths)
+    
+    def __getitem__(self, idx):
+        import numpy as np
+        from PIL import Image
+        
+        try:
+            with Image.open(self.paths[idx]) as pil:
+                # Decode JPEGs at reduced scale and keep only the CLIP-sized crop
+                pil.draft("RGB", (self.input_size, self.input_size))
+                return idx, np.asarray(_center_crop(pil.convert("RGB"), self.input_size))
+        except Exception:
+            return idx, None
+
+
+def _collate_images(items: list) -> tuple:
+    """Collate (idx, array) pairs into (positions, uint8 NCHW tensor), dropping failed decodes."""
+    import torch
+    import numpy as np
+    
+    items = [(idx, arr) for idx, arr in items if arr is not None]
+    if not items:
+        return [], None
+    positions = [idx for idx, _ in items]
+    batch = torch.from_numpy(np.stack([arr for _, arr in items])).permute(0, 3, 1, 2)
+    return positions, batch
+
+
+def _threaded_batches(dataset, batch_size: int, workers: int, prefetch: int = 2):
+    """Yield collated batches from a dataset decoded on a thread pool, `prefetch` batches ahead."""
+    from collections import deque
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for start in range(0, len(dataset), batch_size):
+            stop = min(start + batch_size, len(dataset))
+            in_flight.append([executor.submit(dataset.__getitem__, i) for i in range(start, stop)])
+            if len(in_flight) > prefetch:
+                yield _collate_images([f.result() for f in in_flight.popleft()])
+        while in_flight:
+            yield _collate_images([f.result() for f in in_flight.popleft()])
+
+
+def _center_crop(pil_image, size: int):
+    """Resize (shortest side, bicubic) and center crop a PIL image to size x size."""
+    from PIL import Image
+    
+    if pil_image.size == (size, size):
+        return pil_image
+    
+    width, height = pil_image.size
+    scale = size / min(width, height)
+    new_w = max(size, int(round(width * scale)))
+    new_h = max(size, int(round(height * scale)))
+    resized = pil_image.resize((new_w, new_h), Image.BICUBIC)
+    left = (new_w - size) // 2
+    top = (new_h - size) // 2
+    return resized.crop((left, top, left + size, top + size))
+
+
+_dark_mask_kernel = None
+
+
+def _dark_mask(batch, threshold: float):
+    """
+    Flag images in a uint8 (B, H, W, C) array whose mean luma is below threshold.
+    
+    Uses the same ITU-R 601 weights as PIL's "L" conversion. Runs as a
+    parallel Numba kernel when numba is installed, otherwise in NumPy.
+    """
+    global _dark_mask_kernel
+    import numpy as np
+    
+    if _dark_mask_kernel is None:
+        try:
+            from numba import njit, prange
             
-        except (ImportError, AttributeError):
-            # Brute force without FAISS or if index is numpy array
-            if index_vecs is None or len(index_vecs) == 0:
-                return np.zeros((query_vecs.shape[0], top_k)), np.zeros((query_vecs.shape[0], top_k), dtype=np.int64)
-            
-            query_norm = query_vecs / (np.linalg.norm(query_vecs, axis=1, keepdims=True) + 1e-8)
-            index_norm = index_vecs / (np.linalg.norm(index_vecs, axis=1, keepdims=True) + 1e-8)
+            @njit(parallel=True, cache=True)
+            def kernel(arr, thresh):
+                n, h, w, _ = arr.shape
+                out = np.empty(n, np.bool_)
+                for i in prange(n):
+                    acc = 0.0
+                    for y in range(h):
+                        for x in range(w):
+                            acc += 0.299 * arr[i, y, x, 0] + 0.587 * arr[i, y, x, 1] + 0.114 * arr[i, y, x, 2]
+                    out[i] = acc / (h * w) < thresh
+                return out
             
-            scores = query_norm @ index_norm.T
-            ids = np.argsort(-scores, axis=1)[:, :top_k]
-            scores = np.take_along_axis(scores, ids, axis=1)
+            _dark_mask_kernel = kernel
+        except ImportError:
+            _dark_mask_kernel = False
+    
+    if _dark_mask_kernel:
+        try:
+            return _dark_mask_kernel(np.ascontiguousarray(batch), threshold * 255.0)
+        except Exception:
+            # Compilation is lazy; fall back to NumPy for good if it fails
+            _dark_mask_kernel = False
+    
+    channel_means = batch[..., :3].mean(axis=(1, 2))
+    return channel_means @ np.array([0.299, 0.587, 0.114]) < threshold * 255.0
+
+
+def _gather_image_metrics(args: tuple) -> dict:
+    """
+    Gather metrics for one result image.
+    
+    Module-level and fed only plain values so it can run in a worker process.
+    """
+    import numpy as np
+    from PIL import Image
+    
+    path, score, api_info, brightness_split = args
+    
+    result = {
+        "path": path,
+        "filename": api_info["filename"],
+        "subfolder": api_info["subfolder"],
+        "type": api_info["type"],
+        "similarity": score,
+    }
+    
+    try:
+        stat = os.stat(path)
+        result["file_size"] = stat.st_size
+        result["modified_time"] = stat.st_mtime
+        
+        with Image.open(path) as pil:
+            # Header fields first; draft() changes the reported size
+            result["width"], result["height"] = pil.size
+            result["format"] = pil.format
+            result["mode"] = pil.mode
             
-            return scores, ids
+            # Brightness from a tiny grayscale decode (JPEG uses subsampled IDCT)
+            pil.draft("L", (64, 64))
+            small = pil.convert("L").resize((32, 32), Image.NEAREST)
+            brightness = float(np.asarray(small, dtype=np.uint8).mean() / 255.0)
+        result["brightness"] = brightness
+        result["is_dark"] = brightness < brightness_split
+        
+        has_workflow = False
+        has_prompt = False
+        # Check PNG metadata using direct binary parsing for reliability
+        try:
+            if path.lower().endswith('.png'):
+                metadata = read_text_chunks(path)
+                for key in metadata.keys():
+                    key_lower = key.lower()
+                    if key_lower == "workflow":
+                        has_workflow = bool(metadata[key])
+                    elif key_lower == "prompt":
+                        has_prompt = bool(metadata[key])
+        except Exception:
+            pass
+        
+        result["has_workflow"] = has_workflow
+        result["has_prompt"] = has_prompt
+        
+    except Exception as e:
+        result["error"] = str(e)
+    
+    return result
 
 
-def _read_png_text_chunks(filepath: str) -> dict:
+# JPEG start-of-frame markers carrying the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _read_image_size(filepath: str) -> tuple:
     """
-    Read PNG tEXt/iTXt chunks directly from file binary.
-    This is more reliable than PIL for extracting ComfyUI workflow metadata.
+    Return (width, height) from the file header without decoding pixels.
     
-    Based on ComfyUI frontend's png.ts implementation.
+    PNG and JPEG headers are parsed directly; other formats go through
+    PIL, which also only reads the header on open.
     """
     import struct
     
-    result = {}
+    size = _read_png_dimensions(filepath)
+    if size is not None:
+        return size
     
     with open(filepath, 'rb') as f:
-        # Check PNG signature
-        signature = f.read(8)
-        if signature[:4] != b'\x89PNG':
-            return result  # Not a valid PNG
-        
-        # Read chunks
-        while True:
-            # Read chunk length (4 bytes, big-endian)
-            length_bytes = f.read(4)
-            if len(length_bytes) < 4:
-                break
-            
-            length = struct.unpack('>I', length_bytes)[0]
-            
-            # Read chunk type (4 bytes)
-            chunk_type = f.read(4).decode('ascii', errors='ignore')
-            
-            # Read chunk data
-            data = f.read(length)
-            
-            # Skip CRC (4 bytes)
-            f.read(4)
-            
-            # Handle text chunks
-            if chunk_type in ('tEXt', 'iTXt', 'comf'):
-                try:
-                    # Find null terminator for keyword
-                    null_idx = data.find(b'\x00')
-                    if null_idx > 0:
-                        keyword = data[:null_idx].decode('latin-1')
-                        
-                        if chunk_type == 'iTXt':
-                            # iTXt has compression flag and language tag after keyword
-                            # Format: keyword\0 compression_flag\0 compression_method\0 language\0 translated_keyword\0 text
-                            # Skip to the actual text content
-                            rest = data[null_idx + 1:]
-                            # Find the text after language/translated keyword nulls
-                            text_start = 0
-                            null_count = 0
-                            for i, b in enumerate(rest):
-                                if b == 0:
-                                    null_count += 1
-                                    if null_count >= 4:  # After compression, method, language, translated keyword
-                                        text_start = i + 1
-                                        break
-                            if text_start > 0 and text_start < len(rest):
-                                text = rest[text_start:].decode('utf-8', errors='ignore')
-                            else:
-                                # Simpler case - just keyword\0text
-                                text = rest.decode('utf-8', errors='ignore').lstrip('\x00')
-                        else:
-                            # tEXt and comf: keyword\0text
-                            text = data[null_idx + 1:].decode('utf-8', errors='ignore')
-                        
-                        result[keyword] = text
-                except Exception:
-                    pass
-            
-            # Stop at IEND
-            if chunk_type == 'IEND':
-                break
+        if f.read(2) == b'\xff\xd8':
+            f.seek(2)
+            while True:
+                byte = f.read(1)
+                while byte and byte != b'\xff':
+                    byte = f.read(1)
+                while byte == b'\xff':
+                    byte = f.read(1)
+                if not byte:
+                    break
+                marker = byte[0]
+                if marker in _JPEG_SOF_MARKERS:
+                    f.seek(3, 1)  # Segment length and sample precision
+                    height, width = struct.unpack('>HH', f.read(4))
+                    return width, height
+                if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                    continue  # Markers without a length field
+                length = struct.unpack('>H', f.read(2))[0]
+                f.seek(length - 2, 1)
     
-    return result
+    from PIL import Image
+    with Image.open(filepath) as img:
+        return img.size
+
+
+def _read_png_dimensions(filepath: str):
+    """Return (width, height) from the first 24 bytes of a PNG, or None if it is not one."""
+    import struct
+    
+    with open(filepath, 'rb') as f:
+        head = f.read(24)
+    if len(head) < 24 or head[:8] != b'\x89PNG\r\n\x1a\n' or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>4xII', head[12:24])
+
+
+def _scan_image_files(base_dir: str, extensions: tuple) -> list:
+    """Recursively list (path, mtime) for image files under base_dir using os.scandir."""
+    found = []
+    stack = [base_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(extensions) and entry.is_file():
+                            found.append((entry.path, entry.stat().st_mtime))
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return found
+
+
+def _safe_mtime(filepath: str, default: float = 0) -> float:
+    """Return file mtime, or default if the file cannot be stat'ed."""
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return default
+
+
+def _file_digest(filepath: str) -> str:
+    """Hash of the whole file contents (blake3 when installed, else blake2b)."""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    
+    try:
+        import blake3
+        return blake3.blake3(data).hexdigest(length=16)
+    except ImportError:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _content_key(filepath: str) -> str:
+    """
+    Content-addressed cache key for an image file.
+    
+    Hashes the first 1 MiB plus the file size, which is enough to tell
+    images apart without reading whole files during indexing.
+    """
+    with open(filepath, 'rb') as f:
+        head = f.read(1 << 20)
+        size = os.fstat(f.fileno()).st_size
+    
+    try:
+        import blake3
+        digest = blake3.blake3(head).hexdigest(length=16)
+    except ImportError:
+        digest = hashlib.blake2b(head, digest_size=16).hexdigest()
+    
+    return f"{digest}-{size:x}"
 
 
 # Note: Route registration for /was/image_search/metadata is done in
@@ -0,0 +1,79 @@
+"""
+PNG text chunk reader shared by the image search parser and nodes.
+
+Reads tEXt/iTXt/comf chunks (where ComfyUI stores prompt and workflow JSON)
+straight from the file, seeking past image data.
+"""
+
+import struct
+
+
+def read_text_chunks(filepath: str) -> dict:
+    """
+    Read PNG tEXt/iTXt chunks directly from file binary.
+    This is more reliable than PIL for extracting ComfyUI workflow metadata.
+    
+    Based on ComfyUI frontend's png.ts implementation. Returns {keyword: text};
+    non-PNG files give an empty dict, unreadable files raise OSError.
+    """
+    result: dict = {}
+    
+    with open(filepath, 'rb') as f:
+        # Check PNG signature
+        signature = f.read(8)
+        if signature[:4] != b'\x89PNG':
+            return result  # Not a valid PNG
+        
+        # Read chunks
+        while True:
+            # Read chunk length (4 bytes, big-endian)
+            length_bytes = f.read(4)
+            if len(length_bytes) < 4:
+                break
+            
+            length: int = struct.unpack('>I', length_bytes)[0]
+            
+            # Read chunk type (4 bytes)
+            chunk_type: str = f.read(4).decode('ascii', errors='ignore')
+            
+            # Read text chunk data; seek past pixel data and other chunks
+            # instead of reading them, then skip CRC (4 bytes)
+            if chunk_type in ('tEXt', 'iTXt', 'comf'):
+                data: bytes = f.read(length)
+                f.seek(4, 1)
+            else:
+                f.seek(length + 4, 1)
+            
+            # Handle text chunks
+            if chunk_type in ('tEXt', 'iTXt', 'comf'):
+                try:
+                    # Find null terminator for keyword
+                    null_idx: int = data.find(b'\x00')
+                    if null_idx > 0:
+                        keyword = data[:null_idx].decode('latin-1')
+                        
+                        if chunk_type == 'iTXt':
+                            # iTXt has compression flag and language tag after keyword
+                            # Format: keyword\0 compression_flag\0 compression_method\0 language\0 translated_keyword\0 text
+                            # Skip to the actual text content
+                            rest = data[null_idx + 1:]
+                            # Text follows the 4th null (compression, method, language, translated keyword)
+                            parts = rest.split(b'\x00', 4)
+                            if len(parts) == 5 and parts[4]:
+                                text = parts[4].decode('utf-8', errors='ignore')
+                            else:
+                                # Simpler case - just keyword\0text
+                                text = rest.decode('utf-8', errors='ignore').lstrip('\x00')
+                        else:
+                            # tEXt and comf: keyword\0text
+                            text = data[null_idx + 1:].decode('utf-8', errors='ignore')
+                        
+                        result[keyword] = text
+                except Exception:
+                    pass
+            
+            # Stop at IEND
+            if chunk_type == 'IEND':
+                break
+    
+    return result
@@ -7,68 +7,55 @@ with the ComfyUI_Viewer extension system.
 
 import os
 import json
-import struct
+import asyncio
+import threading
 import torch
 import folder_paths
+from collections import OrderedDict
 
 from aiohttp import web
 from server import PromptServer
 
+try:
+    from ..modules.parsers.png_chunks import read_text_chunks
+except ImportError:
+    # Loaded outside a package: nodes/ and modules/parsers/ are siblings in every install layout
+    import importlib.util
+    _spec = importlib.util.spec_from_file_location(
+        "was_image_search_png_chunks",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules", "parsers", "png_chunks.py"),
+    )
+    _png_chunks = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_png_chunks)
+    read_text_chunks = _png_chunks.read_text_chunks
 
-def _read_png_text_chunks(filepath: str) -> dict:
-    """
-    Read PNG tEXt/iTXt chunks directly from file binary.
-    This is more reliable than PIL for extracting ComfyUI workflow metadata.
-    """
-    result = {}
-    
-    try:
-        with open(filepath, 'rb') as f:
-            signature = f.read(8)
-            if signature[:4] != b'\x89PNG':
-                return result
-            
-            while True:
-                length_bytes = f.read(4)
-                if len(length_bytes) < 4:
-                    break
-                
-                length = struct.unpack('>I', length_bytes)[0]
-                chunk_type = f.read(4).decode('ascii', errors='ignore')
-                data = f.read(length)
-                f.read(4)  # Skip CRC
-                
-                if chunk_type in ('tEXt', 'iTXt', 'comf'):
-                    try:
-                        null_idx = data.find(b'\x00')
-                        if null_idx > 0:
-                            keyword = data[:null_idx].decode('latin-1')
-                            if chunk_type == 'iTXt':
-                                rest = data[null_idx + 1:]
-                                text_start = 0
-                                null_count = 0
-                                for i, b in enumerate(rest):
-                                    if b == 0:
-                                        null_count += 1
-                                        if null_count >= 4:
-                                            text_start = i + 1
-                                            break
-                                if text_start > 0 and text_start < len(rest):
-                                    text = rest[text_start:].decode('utf-8', errors='ignore')
-                                else:
-                                    text = rest.decode('utf-8', errors='ignore').lstrip('\x00')
-                            else:
-                                text = data[null_idx + 1:].decode('utf-8', errors='ignore')
-                            result[keyword] = text
-                    except Exception:
-                        pass
-                
-                if chunk_type == 'IEND':
-                    break
-    except Exception:
-        pass
+
+# Parsed text chunks keyed by (path, mtime_ns, size); repeat hovers skip the file entirely
+_metadata_cache = OrderedDict()
+_METADATA_CACHE_MAX = 512
+_METADATA_CACHE_MAX_FILE_SIZE = 100_000_000
+_metadata_cache_lock = threading.Lock()
+
+# Caps concurrent metadata reads offloaded from the event loop
+_metadata_semaphore = asyncio.Semaphore(4)
+
+
+def _read_png_text_chunks_cached(filepath: str, st: os.stat_result) -> dict:
+    """LRU-cached read_text_chunks; files over 100 MB are parsed but not cached."""
+    key = (filepath, st.st_mtime_ns, st.st_size)
+    with _metadata_cache_lock:
+        metadata = _metadata_cache.get(key)
+        if metadata is not None:
+            _metadata_cache.move_to_end(key)
+            return metadata
     
-    return result
+    metadata = read_text_chunks(filepath)
+    if st.st_size <= _METADATA_CACHE_MAX_FILE_SIZE:
+        with _metadata_cache_lock:
+            _metadata_cache[key] = metadata
+            while len(_metadata_cache) > _METADATA_CACHE_MAX:
+                _metadata_cache.popitem(last=False)
+    return metadata
 
 
 # Register route using decorator pattern (like ComfyUI-Impact-Pack)
@@ -99,7 +86,12 @@ async def get_image_metadata(request):
         else:
             image_path = os.path.join(base_dir, filename)
         
-        if not os.path.exists(image_path):
+        # File I/O runs on the default executor so slow disks don't stall the server
+        loop = asyncio.get_running_loop()
+        try:
+            async with _metadata_semaphore:
+                st = await loop.run_in_executor(None, os.stat, image_path)
+        except OSError:
             print(f"[Image Search] Error: Image not found at {image_path}")
             return web.json_response({'error': 'Image not found'}, status=404)
         
@@ -110,7 +102,8 @@ async def get_image_metadata(request):
         metadata_keys = []
         
         try:
-            metadata = _read_png_text_chunks(image_path)
+            async with _metadata_semaphore:
+                metadata = await loop.run_in_executor(None, _read_png_text_chunks_cached, image_path, st)
             metadata_keys = list(metadata.keys())
             print(f"[Image Search] Found metadata keys: {metadata_keys}")
             
@@ -233,6 +226,9 @@ class WAS_ImageSearchOptions:
                 "rebuild_index": ("BOOLEAN", {"default": False, "tooltip": "Force rebuild of the similarity index. Use if images were modified externally"}),
                 "index_threads": ("INT", {"default": 8, "min": 1, "max": 64, "tooltip": "Number of threads for parallel image loading during indexing"}),
                 "embed_batch_size": ("INT", {"default": 64, "min": 1, "max": 512, "tooltip": "Batch size for CLIP embedding. Lower values use less VRAM"}),
+            },
+            "optional": {
+                "index_dtype": (["fp16", "fp32", "int8"], {"default": "fp16", "tooltip": "Storage precision of the cached index. fp16 halves disk and memory use with negligible accuracy loss, int8 quarters it"}),
             }
         }
 
@@ -262,6 +258,7 @@ class WAS_ImageSearchOptions:
         rebuild_index: bool,
         index_threads: int,
         embed_batch_size: int,
+        index_dtype: str = "fp16",
     ) -> tuple[str]:
         """
         Create a JSON configuration for image search that ComfyUI_Viewer will process.
@@ -288,10 +285,17 @@ class WAS_ImageSearchOptions:
             else:
                 pil_img = Image.fromarray(img_array, mode='RGB')
             
-            img_hash = hashlib.md5(img_array.tobytes()).hexdigest()[:12]
+            # A 1/16 strided sample is plenty for a filename tag
+            sample = img_array[::4, ::4].tobytes()
+            try:
+                import xxhash
+                img_hash = xxhash.xxh3_64(sample).hexdigest()[:12]
+            except ImportError:
+                img_hash = hashlib.blake2b(sample, digest_size=6).hexdigest()
             filename = f"query_{idx:04d}_{img_hash}.png"
             filepath = os.path.join(search_subdir, filename)
-            pil_img.save(filepath, format='PNG')
+            # Temp files read back once by the parser; skip the costly deflate levels
+            pil_img.save(filepath, format='PNG', compress_level=1)
             query_image_paths.append(filepath)
         
         # Build the search options JSON
@@ -316,6 +320,7 @@ class WAS_ImageSearchOptions:
             "rebuild_index": rebuild_index,
             "index_threads": index_threads,
             "embed_batch_size": embed_batch_size,
+            "index_dtype": index_dtype,
         }
         
         result = self.IMAGE_SEARCH_MARKER + json.dumps(options)